@@ -14,22 +14,59 @@
 # limitations under the License.
 #
 
+import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from contextlib import ExitStack
 from functools import partial
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
 import logging
 import os
 import os.path
 import io
+import mimetypes
 import re
+import shutil
+import tempfile
 import json
 import requests
 from requests.adapters import HTTPAdapter
-from time import sleep
+from requests.auth import AuthBase
+from time import monotonic, time
+from urllib3.util.retry import Retry
 import threading
 import webbrowser
 
 # import the connection handler
 from mimiqlink.handler import AuthenticationHandler
+from mimiqlink.multipart import MultipartEncoder
+
+# filename of a downloaded file, as sent in the Content-Disposition header
+_FILENAME_RE = re.compile(r'filename="([^"]+)"')
+
+# connect and read timeouts of the sign-in and refresh requests, so that an
+# unresponsive server can not hold a refresh (and the refresher) forever
+_AUTH_TIMEOUT = (1, 30)
+
+# seconds the details of a finished execution are used without asking the
+# server, and number of executions whose details are kept
+_INFO_DONE_TTL = 30.0
+_INFO_CACHE_SIZE = 256
+
+# number of downloaded files whose ETag is kept for conditional requests
+_ETAG_CACHE_SIZE = 1024
+
+
+def _jwt_exp(token):
+    "Expiration time (unix time) of a JWT, or None if it can not be read."
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(
+            payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
 
 
 class TimeoutHTTPAdapter(HTTPAdapter):
@@ -43,286 +80,508 @@ class TimeoutHTTPAdapter(HTTPAdapter):
         timeout = kwargs.get("timeout")
         if timeout is None and hasattr(self, 'timeout'):
             kwargs["timeout"] = self.timeout
-        # HACK: fix here. used to put timeout=0 (and hence timeout=None) in upload (otherwise we have a timeout)
-        if timeout == 0:
-            kwargs["timeout"] = None
         return super().send(request, **kwargs)
 
 
-class MimiqConnection:
-    def __init__(self, url='https://mimiq.qperfect.io'):
-        self.url = url
+class BaseUrlSession(requests.Session):
+    "Session resolving endpoints (paths starting with '/') against a base url."
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith("/"):
+            url = self.base_url + url
+        return super().request(method, url, *args, **kwargs)
+
+
+class BearerAuth(AuthBase):
+    "Authorize requests with the current access token of a connection."
+
+    def __init__(self, connection):
+        self.connection = connection
+        # last token seen and its header value, swapped as a single tuple
+        self._header = (None, None)
+
+    def __call__(self, request):
+        token = self.connection.access_token
+        if token is not None:
+            header = self._header
+            if header[0] is not token:
+                header = (token, f"Bearer {token}")
+                self._header = header
+            request.headers["Authorization"] = header[1]
+        return request
+
+
+def _new_adapter():
+    "Adapter with the timeouts, retries and pool size used by MimiqConnection."
+    # retry transient failures with exponential backoff, following the
+    # server's Retry-After when given. POST is not retried: uploads stream
+    # their body and it cannot be sent twice.
+    retry = Retry(total=5, backoff_factor=1.0,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset({"GET"}),
+                  respect_retry_after_header=True, raise_on_status=False)
+    return TimeoutHTTPAdapter(
+        timeout=(1, None), max_retries=retry, pool_connections=4, pool_maxsize=32)
 
-        # refresher related variables
+
+class MimiqConnection:
+    # adapters shared by all connections, so that a new connection reuses the
+    # sockets pooled by the previous ones: {url prefix: adapter}
+    _adapters = {}
+
+    def __init__(self, url='https://mimiq.qperfect.io', info_ttl=1.0):
+        # session for doing requests, endpoints are relative to url
+        self.session = BaseUrlSession(url)
+        self.session.auth = BearerAuth(self)
+        for prefix in ('http://', 'https://'):
+            adapter = MimiqConnection._adapters.get(prefix)
+            if adapter is None:
+                # two first connections racing here may both build one, only
+                # the one stored is used from then on
+                adapter = MimiqConnection._adapters.setdefault(prefix, _new_adapter())
+            self.session.mount(prefix, adapter)
+
+        # refresher related variables. The lock only serializes writes of the
+        # token pair, single attribute reads are atomic and need no locking.
         self.refresher_lock = threading.Lock()
+        # serializes refreshes of the access token, so that concurrent
+        # requests finding it expired renew it only once
+        self._renew_lock = threading.Lock()
         self.refresher_task = None
         self.refresher_interval = 15 * 60
-        self.refresher_stop = False
+        # stop event of the current refresher, each refresher gets its own
+        self._stop_event = threading.Event()
+
+        # set once the login page of connect() authenticated successfully
+        self._login_event = threading.Event()
 
         # tokens
         self.access_token = None
         self.refresh_token = None
 
-        # session for doing requests
-        self.session = requests.Session()
-        self.session.mount('http://', TimeoutHTTPAdapter(timeout=(1, None)))
-        self.session.mount('https://', TimeoutHTTPAdapter(timeout=(1, None)))
+        # expiration time of the access token (unix time), if known
+        self._access_exp = None
 
-    def connectUser(self, email, password):
-        "Authenticate to the remote server with the given credentials (email and password)."
-        endpoint = "/api/sign-in"
+        # refresh token last rejected by the server, not to be sent again
+        # until new tokens are obtained
+        self._rejected_token = None
 
-        # prepare the request
-        data = {
-            "email": email,
-            "password": password
-        }
+        # short lived cache of execution details, so that back to back status
+        # checks (e.g. isJobDone followed by isJobFailed) share one request.
+        # Least recently used first: {request: (fetched at, details, ETag)}
+        self.info_ttl = info_ttl
+        self._info_cache = OrderedDict()
+        self._info_lock = threading.Lock()
 
-        # ask for access tokens
-        response = self.session.post(
-            self.url + endpoint, json=data, headers={"Connection": "close"})
+        # ETags of previously downloaded files, for conditional requests. Least
+        # recently used first: {(endpoint, filetype, absolute destdir):
+        # (ETag, filename, size, mtime)}, size and mtime as written by us
+        self._etags = OrderedDict()
+        self._etags_lock = threading.Lock()
 
-        if response.status_code == 200:
-            tokens = response.json()
+        # workers for requestAsync, created on first use
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
-            # set the access tokens
-            with self.refresher_lock:
-                self.access_token = tokens["token"]
-                self.refresh_token = tokens["refreshToken"]
+    @property
+    def url(self):
+        "Url of the remote server."
+        return self.session.base_url
 
-            # update the session headers
-            self.updateSessionHeaders()
+    @url.setter
+    def url(self, url):
+        self.session.base_url = url
 
-            # refresher thread, running in the background
-            self.startRefresher()
-
-            logging.info("Authentication successful.")
-
-        else:
-            reason = response.json()["message"]
-            logging.error(
-                f"Authentication failed with status code {response.status_code} and reason: {reason}")
+    def connectUser(self, email, password):
+        "Authenticate to the remote server with the given credentials (email and password)."
+        self._weblogin({
+            "email": email,
+            "password": password
+        })
 
     def _weblogin(self, data):
         "Authenticate to the remote server with the given credentials. But return the response."
         endpoint = "/api/sign-in"
 
         # ask for access tokens
-        response = self.session.post(
-            self.url + endpoint, json=data, headers={"Connection": "close"})
-
-        if response.status_code == 200:
-            tokens = response.json()
+        response = self.session.post(endpoint, json=data, timeout=_AUTH_TIMEOUT)
 
-            # set the access tokens
-            with self.refresher_lock:
-                self.access_token = tokens["token"]
-                self.refresh_token = tokens["refreshToken"]
+        # parse the body once, it holds either the tokens or the error message.
+        # Errors from proxies or load balancers may not be JSON at all.
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = {}
 
-            self.updateSessionHeaders()
+        if response.status_code == 200:
+            self._setTokens(payload)
 
             # refresher thread, running in the background
             self.startRefresher()
 
             logging.info("Authentication successful.")
+            self._login_event.set()
 
         else:
-            reason = response.json()["message"]
+            reason = payload.get("message", response.reason)
             logging.error(
                 f"Authentication failed with status code {response.status_code} and reason: {reason}")
 
         return response
 
+    def _setTokens(self, tokens, stop=None):
+        "Store the tokens returned by the server."
+        # read both tokens first, so that a missing one changes nothing
+        access_token, refresh_token = tokens["token"], tokens["refreshToken"]
+        with self.refresher_lock:
+            # the tokens were asked for by a refresh of a connection closed
+            # since (`stop` is set): store nothing and report the failure
+            if stop is not None and stop.is_set():
+                return False
+            self.access_token = access_token
+            self.refresh_token = refresh_token
+            self._access_exp = _jwt_exp(access_token)
+            self._rejected_token = None
+        return True
+
     def connectToken(self, token):
         "Authenticate to the remote server with the given refresh token"
 
         # set the refresh token
-        with self.refresher_lock:
-            self.refresh_token = token
+        self.refresh_token = token
 
         # refresh
         status = self.refresh()
 
         if status:
             logging.info("Authentication successfull.")
-            self.updateSessionHeaders()
             self.startRefresher()
         else:
             logging.error("Authentication failed.")
 
+        return status
+
     def startRefresher(self):
         "Start a refresher task"
-        self.refresher_task = threading.Thread(target=self.refresher)
-        self.refresher_task.start()
-
-    def refresher(self):
+        with self.refresher_lock:
+            # a running refresher will keep on refreshing the new tokens
+            task = self.refresher_task
+            if task is not None and task.is_alive() and not self._stop_event.is_set():
+                return
+            # a new event, so that a stopped refresher still busy with a slow
+            # refresh stays stopped when the connection is opened again
+            self._stop_event = threading.Event()
+            self.refresher_task = threading.Thread(
+                target=self.refresher, args=(self._stop_event,), daemon=True)
+            self.refresher_task.start()
+
+    def refresher(self, stop):
         "Refresher function. Will refresh the access token with the refresh token every configured interval."
-        while True:
-
-            # check the stop flag every second
-            for i in range(self.refresher_interval):
-                sleep(1)
-                with self.refresher_lock:
-                    if self.refresher_stop:
-                        break
+        # wait for the next refresh, waking up immediately if asked to stop
+        while not stop.wait(self._refreshDelay()):
+            token = self.access_token
+            status = self._renew(token, stop)
 
-            with self.refresher_lock:
-                if self.refresher_stop:
+            # retry a failed refresh a few times, backing off exponentially,
+            # so that a transient error does not close the connection
+            for attempt in range(3):
+                if status or stop.wait(2 ** attempt):
                     break
+                status = self._renew(token, stop)
 
-            status = self.refresh()
+            if stop.is_set():
+                break
 
             if not status:
                 logging.error(
                     "Access token refresh failed. Connection is closed")
+                break
+
+    def _renew(self, token, stop=None):
+        "Refresh the access token, unless another thread already replaced `token`."
+        with self._renew_lock:
+            if self.access_token is not token:
+                return self.access_token is not None
+            # the server already refused this refresh token, asking again
+            # can only fail the same way
+            if self.refresh_token is not None and self.refresh_token == self._rejected_token:
+                return False
+            return self.refresh(stop)
+
+    def _refreshDelay(self):
+        "Seconds until the access token should be refreshed."
+        exp = self._access_exp
+        if exp is None:
+            return self.refresher_interval
 
-    def refresh(self):
+        # refresh a minute before the token expires
+        return max(60, exp - time() - 60)
+
+    def refresh(self, stop=None):
         "Refresh the access token using the refresh token."
+        # the new tokens are dropped if `stop` is set before they arrive
         endpoint = "/api/access-token"
 
         # prepare the request
-        with self.refresher_lock:
-            data = {
-                "refreshToken": self.refresh_token
-            }
+        data = {
+            "refreshToken": self.refresh_token
+        }
 
         # ask for a new access token
-        response = self.session.post(
-            self.url + endpoint, json=data, headers={"Connection": "close"})
+        try:
+            response = self.session.post(endpoint, json=data, timeout=_AUTH_TIMEOUT)
+        except requests.RequestException as e:
+            logging.warning(f"Access token refresh failed: {e}")
+            return False
 
         # check if the response is valid
         if response.status_code != 200:
+            # remember a refresh token the server refused, but not one that
+            # failed for a transient reason (e.g. 429 or 5xx)
+            if response.status_code in (400, 401, 403):
+                self._rejected_token = data["refreshToken"]
             return False
 
-        tokens = response.json()
+        # a malformed body must not kill the refresher thread
+        try:
+            return self._setTokens(response.json(), stop)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Access token refresh failed: invalid response ({e})")
+            return False
 
-        # write the new tokens
-        with self.refresher_lock:
-            self.access_token = tokens["token"]
-            self.refresh_token = tokens["refreshToken"]
+    def _api(self, method, endpoint, error, **kwargs):
+        "Send an authenticated request to one of the API endpoints."
+        # returns None, logging `error`, if not authenticated or if the server
+        # answered with an error
+        if not self.checkAuth():
+            return None
 
-        self.updateSessionHeaders()
+        # the refresher may have fallen behind, e.g. while the machine was
+        # asleep: renew an expired token before using it
+        # renewals started here are dropped too if the connection is closed
+        stop = self._stop_event
+        token = self.access_token
+        exp = self._access_exp
+        renewable = True
+        if exp is not None and time() > exp - 10:
+            renewable = self._renew(token, stop)
+            token = self.access_token
 
-        return True
+        response = self.session.request(method, endpoint, **kwargs)
 
-    def request(self, name, label, uploads):
-        "Request an execution to the remote server"
+        # token rejected by the server: renew it and try once more, unless
+        # renewing it just failed. Only GETs are sent again, uploads stream a
+        # body that can not be replayed.
+        if (response.status_code == 401 and method == "GET" and renewable
+                and self._renew(token, stop)):
+            response.close()
+            response = self.session.request(method, endpoint, **kwargs)
 
-        if not self.checkAuth():
+        # 304 answers a conditional request, the caller has the content already
+        if response.status_code >= 300 and response.status_code != 304:
+            logging.error(
+                f"{error}. Server responded with {response.status_code}")
+            response.close()
             return None
 
-        endpoint = "/api/request"
+        return response
 
-        data = [("name", (None, name)), ("label", (None, label))]
+    def request(self, name, label, uploads):
+        "Request an execution to the remote server"
 
-        for file in uploads:
-            if isinstance(file, io.IOBase) and not file.closed:
-                data.append(("uploads", (os.path.basename(file.name), file)))
-            else:
+        endpoint = "/api/request"
+
+        # files opened here are closed once the upload is done, even on errors
+        with ExitStack() as stack:
+            data = [("name", (None, name)), ("label", (None, label))]
+
+            for idx, file in enumerate(uploads):
+                if isinstance(file, io.IOBase) and not file.closed:
+                    fh = file
+                    # in-memory buffers have no name
+                    filename = os.path.basename(
+                        str(getattr(file, "name", f"upload{idx}")))
+                else:
+                    # paths are opened once, str and os.PathLike alike
+                    fh = stack.enter_context(open(file, "rb", buffering=1 << 20))
+                    filename = os.path.basename(file)
+                mimetype, _ = mimetypes.guess_type(filename)
                 data.append(
-                    ("uploads", (os.path.basename(file), open(file, "rb"))))
+                    ("uploads", (filename, fh, mimetype or "application/octet-stream")))
 
-        response = self.session.post(
-            self.url + endpoint, files=data, timeout=0)
+            # stream the multipart body from disk instead of building it in memory
+            body = MultipartEncoder(data)
+            response = self._api(
+                "POST", endpoint, "File upload failed", data=body,
+                headers={"Content-Type": body.content_type}, timeout=(5, None))
 
-        if response.status_code != 200:
-            logging.error(
-                f"File upload failed with status code {response.status_code}")
+        if response is None:
             return None
 
         return response.json()["executionRequestId"]
 
+    def requestAsync(self, name, label, uploads):
+        "Request an execution to the remote server, uploading in the background."
+        # the returned Future resolves to what `request` returns, so that the
+        # next job can be prepared while files are sent
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=4)
+            return self._executor.submit(self.request, name, label, uploads)
+
     def requestInfo(self, request):
-        if not self.checkAuth():
-            return None
+        # a copy, so that callers can not alter what later calls return
+        return deepcopy(self._requestInfo(request))
+
+    def _requestInfo(self, request):
+        "Details of an execution, shared with the cache: not to be modified."
+        with self._info_lock:
+            cached = self._info_cache.get(request)
+            if cached is not None:
+                self._info_cache.move_to_end(request)
+
+        # details of finished executions change rarely, keep them for longer
+        if cached is not None:
+            finished = cached[1].get("status") in ("DONE", "ERROR")
+            ttl = _INFO_DONE_TTL if finished else self.info_ttl
+            if monotonic() - cached[0] < ttl:
+                return cached[1]
 
         endpoint = f"/api/request/{request}"
 
-        response = self.session.get(self.url + endpoint)
+        # revalidate what we got last time instead of downloading it again
+        headers = {}
+        if cached is not None and cached[2] is not None:
+            headers["If-None-Match"] = cached[2]
 
-        if response.status_code != 200:
-            print(
-                f"Failed to retrieve execution details for {request}. Server responded with {response.status_code}")
+        response = self._api(
+            "GET", endpoint, f"Failed to retrieve execution details for {request}",
+            headers=headers)
+
+        if response is None:
             return {}
 
-        return response.json()
+        if response.status_code == 304:
+            infos, etag = cached[1], cached[2]
+        else:
+            infos, etag = response.json(), response.headers.get("ETag")
+
+        with self._info_lock:
+            self._info_cache[request] = (monotonic(), infos, etag)
+            self._info_cache.move_to_end(request)
+            while len(self._info_cache) > _INFO_CACHE_SIZE:
+                self._info_cache.popitem(last=False)
+
+        return infos
+
+    def jobStatus(self, request):
+        "Status of an execution (NEW, RUNNING, DONE, ERROR, ...), or None if unavailable."
+        return self._requestInfo(request).get("status")
 
     def isJobDone(self, request):
-        infos = self.requestInfo(request)
-        status = infos["status"]
+        status = self.jobStatus(request)
         return status == "DONE" or status == "ERROR"
 
     def isJobFailed(self, request):
-        infos = self.requestInfo(request)
-        status = infos["status"]
+        status = self.jobStatus(request)
         return status == "ERROR"
 
     def isJobStarted(self, request):
-        infos = self.requestInfo(request)
-        status = infos["status"]
-        return status != "NEW"
-
-    def updateSessionHeaders(self):
-        # fetch the access token
-        with self.refresher_lock:
-            token = self.access_token
-
-        # build the headers
-        self.session.headers.update({"Authorization": f"Bearer {token}"})
+        status = self.jobStatus(request)
+        return status is not None and status != "NEW"
 
     def checkAuth(self):
-        with self.refresher_lock:
-            if self.access_token is None:
-                logging.error("Not yet authenticated.")
-                return False
+        # reading a single attribute is atomic, no need to take the lock here
+        if self.access_token is None:
+            logging.error("Not yet authenticated.")
+            return False
 
         return True
 
     def downloadFile(self, request, index, filetype, destdir):
-        if not self.checkAuth():
-            return None
-
-        endpoint = f"/api/files/{request}/{index}?source={filetype}"
+        endpoint = f"/api/files/{request}/{index}"
+
+        # revalidate the file we got last time, if it is still on disk as we
+        # wrote it: not overwritten by another download nor edited since
+        key = (endpoint, filetype, os.path.abspath(destdir))
+        with self._etags_lock:
+            tagged = self._etags.get(key)
+            if tagged is not None:
+                self._etags.move_to_end(key)
+        headers = {}
+        if tagged is not None:
+            try:
+                st = os.stat(os.path.join(destdir, tagged[1]))
+            except OSError:
+                st = None
+            if st is not None and (st.st_size, st.st_mtime_ns) == tagged[2:]:
+                headers["If-None-Match"] = tagged[0]
+            else:
+                tagged = None
 
-        response = self.session.get(self.url + endpoint)
+        # stream the body so large files never have to fit in memory
+        response = self._api(
+            "GET", endpoint, f"Failed to retrieve {filetype} files for {request}",
+            params={"source": filetype}, headers=headers, stream=True)
 
-        if response.status_code >= 300:
-            logging.error(
-                f"Failed to retrieve {filetype} files for {request}. Server responded with {response.status_code}")
+        if response is None:
             return None
 
-        filename = re.findall(
-            'filename="(.+)"', response.headers.get('Content-Disposition'))[0]
-        #print(f"Saving {filename} in {destdir}")
+        with response:
+            # not modified, the file on disk is already up to date
+            if response.status_code == 304:
+                return tagged[1] if tagged is not None else None
 
-        # Should never happen, but just in case.
-        # If it does, we can't do anything about it here. We need to patch the server
-        if not filename:
-            logging.error(
-                f"Something went wrong. Server is missing the filename")
-            return None
+            match = _FILENAME_RE.search(
+                response.headers.get('Content-Disposition', ''))
+            filename = match.group(1) if match else None
+            #print(f"Saving {filename} in {destdir}")
 
-        # at this point we should have a valid filename and a valid directory
-        # so we write everything to the file
-        with open(os.path.join(destdir, filename), 'wb') as f:
-            f.write(response.content)
+            # Should never happen, but just in case.
+            # If it does, we can't do anything about it here. We need to patch the server
+            if not filename:
+                logging.error(
+                    f"Something went wrong. Server is missing the filename")
+                return None
+
+            # at this point we should have a valid filename and a valid directory
+            # so we copy the body to the file, one chunk at a time
+            response.raw.decode_content = True
+            filepath = os.path.join(destdir, filename)
+            with open(filepath, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=1 << 20)
+
+            etag = response.headers.get("ETag")
+            with self._etags_lock:
+                if etag:
+                    st = os.stat(filepath)
+                    self._etags[key] = (etag, filename, st.st_size, st.st_mtime_ns)
+                    self._etags.move_to_end(key)
+                    while len(self._etags) > _ETAG_CACHE_SIZE:
+                        self._etags.popitem(last=False)
+                else:
+                    self._etags.pop(key, None)
 
         return filename
 
-    def downloadFiles(self, request, source, destdir=None):
+    def downloadFiles(self, request, source, destdir=None, infos=None, max_workers=8):
         if not self.checkAuth():
             return None
 
         if destdir is None:
             destdir = os.path.join("./", request)
 
-        # if the directory alreayd exists send a warning, otherwise create it
-        try:
-            os.mkdir(destdir)
-        except FileExistsError:
-            logging.warning(f"Directory {destdir} already exists.")
+        # create the directory once for all the files, it may already exist
+        os.makedirs(destdir, exist_ok=True)
 
-        infos = self.requestInfo(request)
+        # execution details can be shared by callers downloading both the
+        # uploads and the results of the same request
+        if infos is None:
+            infos = self._requestInfo(request)
 
         if source == "uploads":
             sourcename = "numberOfUploadedFiles"
@@ -331,10 +590,13 @@ class MimiqConnection:
 
         nf = infos.get(sourcename, 0)
 
-        names = []
-        for idx in range(nf):
-            name = self.downloadFile(request, idx, source, destdir)
-            names.append(name)
+        if nf == 0:
+            return []
+
+        # files are independent, download them concurrently over the session pool
+        with ThreadPoolExecutor(max_workers=min(nf, max_workers)) as executor:
+            names = list(executor.map(
+                lambda idx: self.downloadFile(request, idx, source, destdir), range(nf)))
 
         return names
 
@@ -346,21 +608,54 @@ class MimiqConnection:
 
     def connect(self):
         "Authenticate to the remote services by taking credentials from a locally shown login page"
-        h = partial(AuthenticationHandler,
-                    lambda data: self._weblogin(data))
-        with HTTPServer(('', 0), h) as httpd:
+        h = partial(AuthenticationHandler, self._weblogin)
+        self._login_event.clear()
+        # assets are served in parallel, on daemon threads that do not hold
+        # up the shutdown
+        with ThreadingHTTPServer(('', 0), h) as httpd:
             port = httpd.server_port
             print(
                 f"Starting authentication server on port {port} (http://localhost:{port})")
+
+            # serve the login page in the background until the login succeeds
+            server = threading.Thread(target=httpd.serve_forever, daemon=True)
+            server.start()
             webbrowser.open(f"http://localhost:{port}", new=2)
-            while self.access_token is None:
-                httpd.handle_request()
+            self._login_event.wait()
+            httpd.shutdown()
+            server.join()
 
     def savetoken(self, filepath="qperfect.json"):
+        # reuse a token saved earlier for the same server, if it is still
+        # valid, instead of asking for the credentials again
+        if self.refresh_token is None and os.path.exists(filepath):
+            try:
+                with open(filepath, 'r') as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+            if data.get('url') == self.url and data.get('token') is not None:
+                if not self.connectToken(data['token']):
+                    self.refresh_token = None
+
         if self.refresh_token is None:
             self.connect()
-        with open(filepath, 'w') as f:
-            json.dump({'token': self.refresh_token, 'url': self.url}, f)
+
+        # write a temporary file and rename it over the old one, so that a
+        # crash or a concurrent loadtoken never sees a truncated file. The
+        # file is synced first, or the rename could land before its content.
+        payload = json.dumps({'token': self.refresh_token, 'url': self.url})
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(filepath) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmppath, filepath)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
 
     def loadtoken(self, filepath="qperfect.json"):
         with open(filepath, 'r') as f:
@@ -370,19 +665,38 @@ class MimiqConnection:
             self.connectToken(token)
 
     def close(self):
-        # ask the refresher to stop
+        # let pending background uploads finish, while tokens are still valid
+        with self._executor_lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
+
+        # ask the refresher to stop, together with startRefresher so that no
+        # new refresher is started in between
         with self.refresher_lock:
-            self.refresher_stop = True
+            self._stop_event.set()
+            task = self.refresher_task
+            self.refresher_task = None
 
-        # join the thread
-        self.refresher_task.join()
+        # join the thread outside of the lock, the refresher may need it to
+        # store tokens before seeing the stop request. Do not wait forever on
+        # a refresh that is stuck reading from the server.
+        if task is not None:
+            task.join(timeout=5)
 
         # clean the tokens
-        self.access_token = None
-        self.refresh_token = None
+        with self.refresher_lock:
+            self.access_token = None
+            self.refresh_token = None
+
+    @classmethod
+    def closePools(cls):
+        "Close the connections pooled for all MimiqConnection instances."
+        for adapter in cls._adapters.values():
+            adapter.close()
 
     def isOpen(self):
-        a = self.refresher_task is not None
-        b = self.refresher_task.is_alive()
-        c = self.access_token is not None
-        return a and b and c
+        # snapshot the task once, it may be replaced by another thread
+        task = self.refresher_task
+        return task is not None and task.is_alive() and self.access_token is not None
@@ -19,8 +19,32 @@ import json
 import mimetypes
 import os
 
+# files of the login page, read from disk on first use: {path: (content, mimetype)}
+_PUBLIC_DIR = os.path.join(os.path.dirname(__file__), 'public')
+_STATIC_CACHE = {}
+
+
+def _load_static(path):
+    "Content and mimetype of a file in the public folder."
+    entry = _STATIC_CACHE.get(path)
+    if entry is None:
+        filepath = os.path.join(_PUBLIC_DIR, path.lstrip('/'))
+        with open(filepath, 'rb') as file:
+            content = file.read()
+        mimetype, _ = mimetypes.guess_type(filepath)
+        entry = (content, mimetype or "")
+        _STATIC_CACHE[path] = entry
+    return entry
+
 
 class AuthenticationHandler(BaseHTTPRequestHandler):
+    # keep the browser connection open across the page and its assets. Every
+    # response must then carry a Content-Length.
+    protocol_version = 'HTTP/1.1'
+    # seconds an idle kept-alive connection is waited on. Shutting down the
+    # server does not stop the handler threads, this does.
+    timeout = 10
+
     def __init__(self, authenticate_function, *args, **kwargs):
         self.authenticate_function = authenticate_function
         # BaseHTTPRequestHandler calls do_GET **inside** __init__ !!!
@@ -33,18 +57,12 @@ class AuthenticationHandler(BaseHTTPRequestHandler):
             if self.path == '/':
                 self.path = '/index.html'
 
-            public_dir = os.path.join(os.path.dirname(__file__), 'public')
-            filepath = os.path.join(public_dir, self.path.lstrip('/'))
-
-            with open(filepath, 'rb') as file:
-                content = file.read()
-                mimetype, _ = mimetypes.guess_type(filepath)
-                if not mimetype:
-                    mimetype = ""
-                self.send_response(200)
-                self.send_header('Content-type', mimetype)
-                self.end_headers()
-                self.wfile.write(content)
+            content, mimetype = _load_static(self.path)
+            self.send_response(200)
+            self.send_header('Content-type', mimetype)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
         except:
             self.send_error(404)
 
@@ -61,9 +79,12 @@ class AuthenticationHandler(BaseHTTPRequestHandler):
                 self.send_response(response.status_code)
                 # FIX: should be the same content-type as the response?
                 self.send_header('Content-type', 'application/json')
+                self.send_header('Content-Length', str(len(response.content)))
                 self.end_headers()
                 self.wfile.write(response.content)
             except:
-                self.send_response(400)
+                self.send_error(400)
+            # the login is over, do not wait for more requests from the page
+            self.close_connection = True
         else:
             self.send_error(404)
@@ -0,0 +1,126 @@
+#
+# Copyright © 2022-2023 University of Strasbourg. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import os
+import stat
+import uuid
+
+
+def _quote(value):
+    "Escape a header parameter value the same way browsers do for form data."
+    return value.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+def _stream_size(fileobj):
+    "Bytes left to read in a regular binary file or BytesIO, None for anything else."
+    try:
+        if isinstance(fileobj, io.BytesIO):
+            return len(fileobj.getbuffer()) - fileobj.tell()
+        # wrappers like GzipFile also have a fileno, but of a file whose size
+        # is not the size of what they read
+        if not isinstance(fileobj, (io.FileIO, io.BufferedReader, io.BufferedRandom)):
+            return None
+        if not fileobj.seekable():
+            return None
+        st = os.fstat(fileobj.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return max(0, st.st_size - fileobj.tell())
+    except (OSError, ValueError):
+        return None
+
+
+class MultipartEncoder:
+    """
+    File-like multipart/form-data body that is read lazily.
+
+    Fields are given as a list of `(name, (filename, value[, content_type]))`
+    tuples, as for the `files` argument of `requests`. Plain fields use `None`
+    as filename and a string value; file fields use an open file.
+    Regular binary files are never loaded in memory: they are read chunk by
+    chunk while `requests` sends the body. Other file objects (text files,
+    pipes, compressed files, ...) have no size known in advance and are read
+    whole, as `requests` would.
+    """
+
+    def __init__(self, fields, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+
+        # sequence of byte strings and [file, bytes left] pairs making up the body
+        self._parts = []
+        for name, value in fields:
+            filename, content = value[0], value[1]
+            header = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"'
+            if filename is not None:
+                header += f'; filename="{_quote(filename)}"'
+            if len(value) > 2 and value[2]:
+                header += f'\r\nContent-Type: {value[2]}'
+            self._parts.append((header + '\r\n\r\n').encode())
+            if isinstance(content, (str, bytes, bytearray, memoryview)):
+                size = None
+            else:
+                # only stream what has a trustworthy size, the Content-Length
+                # is sent before the body
+                size = _stream_size(content)
+                if size is None:
+                    content = content.read()
+            if isinstance(content, str):
+                content = content.encode()
+            if size is None:
+                self._parts.append(bytes(content))
+            else:
+                self._parts.append([content, size])
+            self._parts.append(b'\r\n')
+        self._parts.append(f'--{self.boundary}--\r\n'.encode())
+
+        self._length = sum(len(p) if isinstance(p, bytes) else p[1]
+                           for p in self._parts)
+        self._current = 0
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._current < len(self._parts) and size != 0:
+            part = self._parts[self._current]
+            if isinstance(part, bytes):
+                chunk = part if size < 0 else part[:size]
+                rest = part[len(chunk):]
+                if rest:
+                    self._parts[self._current] = rest
+                else:
+                    self._current += 1
+            else:
+                # never read past the size announced in the Content-Length
+                left = part[1]
+                chunk = part[0].read(left if size < 0 else min(size, left))
+                part[1] -= len(chunk)
+                if not chunk or part[1] == 0:
+                    self._current += 1
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(1 << 16)
+            if not chunk:
+                break
+            yield chunk
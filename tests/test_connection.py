@@ -0,0 +1,231 @@
+#
+# Copyright © 2022-2023 University of Strasbourg. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import base64
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from mimiqlink import MimiqConnection
+
+
+def jwt(exp):
+    "Unsigned JWT expiring at `exp` (unix time)."
+    claims = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode()
+    return f"header.{claims.rstrip('=')}.signature"
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None, headers=None, content=b""):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = headers or {}
+        self.reason = ""
+        self.raw = io.BytesIO(content)
+
+    def json(self):
+        return self.payload
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSession:
+    "Session answering requests with `handler(method, url, kwargs)`, recording them."
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url))
+        return self.handler(method, url, kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class TestTokenRenewal(unittest.TestCase):
+    def setUp(self):
+        self.connection = MimiqConnection()
+        self.connection.refresh_token = "refresh"
+
+    def setAccessToken(self, token):
+        self.connection.access_token = token
+        self.connection._access_exp = json.loads(base64.urlsafe_b64decode(
+            token.split('.')[1] + '==')).get("exp")
+
+    def test_expired_token_is_renewed_before_sending(self):
+        fresh = jwt(time.time() + 3600)
+
+        def handler(method, url, kwargs):
+            if url == "/api/access-token":
+                return FakeResponse(200, {"token": fresh, "refreshToken": "new"})
+            return FakeResponse(200, {"status": "DONE"})
+
+        self.setAccessToken(jwt(time.time() - 60))
+        self.connection.session = FakeSession(handler)
+
+        response = self.connection._api("GET", "/api/request/1", "error")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.connection.session.calls,
+                         [("POST", "/api/access-token"), ("GET", "/api/request/1")])
+        self.assertIs(self.connection.access_token, fresh)
+        self.assertEqual(self.connection.refresh_token, "new")
+
+    def test_rejected_token_is_renewed_and_get_retried(self):
+        old, fresh = jwt(time.time() + 3600), jwt(time.time() + 7200)
+
+        def handler(method, url, kwargs):
+            if url == "/api/access-token":
+                return FakeResponse(200, {"token": fresh, "refreshToken": "new"})
+            if self.connection.access_token is old:
+                return FakeResponse(401)
+            return FakeResponse(200, {"status": "DONE"})
+
+        self.setAccessToken(old)
+        self.connection.session = FakeSession(handler)
+
+        response = self.connection._api("GET", "/api/request/1", "error")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.connection.session.calls, [
+            ("GET", "/api/request/1"),
+            ("POST", "/api/access-token"),
+            ("GET", "/api/request/1")])
+
+    def test_post_is_not_retried(self):
+        fresh = jwt(time.time() + 7200)
+
+        def handler(method, url, kwargs):
+            if url == "/api/access-token":
+                return FakeResponse(200, {"token": fresh, "refreshToken": "new"})
+            return FakeResponse(401)
+
+        self.setAccessToken(jwt(time.time() + 3600))
+        self.connection.session = FakeSession(handler)
+
+        self.assertIsNone(self.connection._api("POST", "/api/request", "error"))
+        self.assertEqual(self.connection.session.calls, [("POST", "/api/request")])
+
+    def test_rejected_refresh_token_is_sent_once(self):
+        def handler(method, url, kwargs):
+            return FakeResponse(401)
+
+        self.setAccessToken(jwt(time.time() - 60))
+        self.connection.session = FakeSession(handler)
+
+        self.assertIsNone(self.connection._api("GET", "/api/request/1", "error"))
+        self.assertIsNone(self.connection._api("GET", "/api/request/2", "error"))
+
+        self.assertEqual(self.connection.session.calls, [
+            ("POST", "/api/access-token"),
+            ("GET", "/api/request/1"),
+            ("GET", "/api/request/2")])
+
+    def test_new_tokens_clear_the_rejected_token(self):
+        answers = [FakeResponse(401)] + [
+            FakeResponse(200, {"token": jwt(time.time() - 60), "refreshToken": "new"})] * 2
+
+        def handler(method, url, kwargs):
+            if url == "/api/access-token":
+                return answers.pop(0)
+            return FakeResponse(200, {})
+
+        self.setAccessToken(jwt(time.time() - 60))
+        self.connection.session = FakeSession(handler)
+        self.connection._api("GET", "/api/request/1", "error")
+
+        # connecting again with another token (as connectToken does) gives
+        # new tokens, which are renewed as usual
+        self.connection.refresh_token = "other"
+        self.assertTrue(self.connection.refresh())
+        self.connection._api("GET", "/api/request/2", "error")
+        self.assertEqual(answers, [])
+
+
+
+class TestDownloadFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.destdir = self.tmpdir.name
+
+        # every request has one result file, results.txt, tagged by content
+        self.files = {"R1": b"first results", "R2": b"second results"}
+
+        def handler(method, url, kwargs):
+            request = url.split("/")[3]
+            if url.startswith("/api/request/"):
+                return FakeResponse(200, {"status": "DONE", "numberOfResultedFiles": 1})
+            content = self.files[request]
+            etag = f'"{request}-{len(content)}"'
+            if kwargs.get("headers", {}).get("If-None-Match") == etag:
+                return FakeResponse(304)
+            return FakeResponse(200, headers={
+                "Content-Disposition": 'attachment; filename="results.txt"',
+                "ETag": etag}, content=content)
+
+        self.connection = MimiqConnection()
+        self.connection.access_token = "token"
+        self.connection.session = FakeSession(handler)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def download(self, request):
+        self.assertEqual(self.connection.downloadResults(request, destdir=self.destdir),
+                         ["results.txt"])
+        with open(os.path.join(self.destdir, "results.txt"), "rb") as f:
+            return f.read()
+
+    def fileGets(self):
+        return [call for call in self.connection.session.calls if "/api/files/" in call[1]]
+
+    def test_unchanged_file_is_not_downloaded_again(self):
+        self.assertEqual(self.download("R1"), b"first results")
+        self.assertEqual(self.download("R1"), b"first results")
+        self.assertEqual(len(self.fileGets()), 2)
+
+    def test_overwritten_file_is_downloaded_again(self):
+        # both requests send a results.txt, in the same directory
+        self.assertEqual(self.download("R1"), b"first results")
+        self.assertEqual(self.download("R2"), b"second results")
+        self.assertEqual(self.download("R1"), b"first results")
+
+    def test_edited_file_is_downloaded_again(self):
+        self.download("R1")
+        with open(os.path.join(self.destdir, "results.txt"), "wb") as f:
+            f.write(b"edited")
+        self.assertEqual(self.download("R1"), b"first results")
+
+    def test_removed_file_is_downloaded_again(self):
+        self.download("R1")
+        os.remove(os.path.join(self.destdir, "results.txt"))
+        self.assertEqual(self.download("R1"), b"first results")
+
+
+if __name__ == '__main__':
+    unittest.main()
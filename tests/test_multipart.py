@@ -0,0 +1,155 @@
+#
+# Copyright © 2022-2023 University of Strasbourg. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import email.parser
+import email.policy
+import gzip
+import io
+import os
+import tempfile
+import unittest
+
+from mimiqlink.multipart import MultipartEncoder
+
+
+def parse(encoder, body):
+    "Parts of a multipart body as a list of (name, filename, content type, payload)."
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {encoder.content_type}\r\n\r\n".encode() + body)
+    return [(part.get_param("name", header="content-disposition"),
+             part.get_filename(),
+             part.get("Content-Type"),
+             part.get_payload(decode=True))
+            for part in message.iter_parts()]
+
+
+class TestMultipartEncoder(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.textpath = os.path.join(self.tmpdir.name, "circuit.txt")
+        with open(self.textpath, "w", encoding="utf-8") as f:
+            f.write("héllo\nwörld\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fields(self, stack):
+        binary = open(self.textpath, "rb")
+        text = open(self.textpath, "r", encoding="utf-8")
+        stack.extend([binary, text])
+        return [
+            ("name", (None, "job")),
+            ("label", (None, b"raw bytes")),
+            ("uploads", ("data.bin", io.BytesIO(b"\x00\x01" * 1000), "application/octet-stream")),
+            ("uploads", ("circuit.txt", binary, "text/plain")),
+            ("uploads", ("circuit.txt", text)),
+            ("uploads", ("notes.txt", io.StringIO("some notes"))),
+        ]
+
+    def test_parts(self):
+        opened = []
+        try:
+            encoder = MultipartEncoder(self.fields(opened))
+            body = encoder.read()
+        finally:
+            for f in opened:
+                f.close()
+
+        self.assertEqual(len(encoder), len(body))
+        self.assertEqual(parse(encoder, body), [
+            ("name", None, None, b"job"),
+            ("label", None, None, b"raw bytes"),
+            ("uploads", "data.bin", "application/octet-stream", b"\x00\x01" * 1000),
+            ("uploads", "circuit.txt", "text/plain", "héllo\nwörld\n".encode()),
+            ("uploads", "circuit.txt", None, "héllo\nwörld\n".encode()),
+            ("uploads", "notes.txt", None, b"some notes"),
+        ])
+
+    def test_pipe(self):
+        # a pipe reports no size, its content must be read before sending
+        r, w = os.pipe()
+        os.write(w, b"piped content")
+        os.close(w)
+        with os.fdopen(r, "rb") as pipe:
+            encoder = MultipartEncoder([("uploads", ("pipe.bin", pipe))])
+            body = encoder.read()
+
+        self.assertEqual(len(encoder), len(body))
+        self.assertEqual(parse(encoder, body),
+                         [("uploads", "pipe.bin", None, b"piped content")])
+
+    def test_gzip(self):
+        # the size on disk of a compressed file is not the size of its content
+        gzpath = os.path.join(self.tmpdir.name, "data.gz")
+        with gzip.open(gzpath, "wb") as f:
+            f.write(b"a" * 10000)
+        with gzip.open(gzpath, "rb") as f:
+            encoder = MultipartEncoder([("uploads", ("data", f))])
+            body = encoder.read()
+
+        self.assertEqual(len(encoder), len(body))
+        self.assertEqual(parse(encoder, body),
+                         [("uploads", "data", None, b"a" * 10000)])
+
+    def test_partially_read_file(self):
+        # only what is left in a regular file is sent, without loading it
+        with open(self.textpath, "rb") as f:
+            f.read(3)
+            encoder = MultipartEncoder([("uploads", ("circuit.txt", f))])
+            body = encoder.read()
+
+        self.assertEqual(len(encoder), len(body))
+        self.assertEqual(parse(encoder, body),
+                         [("uploads", "circuit.txt", None, "héllo\nwörld\n".encode()[3:])])
+
+    def test_quoted_names(self):
+        encoder = MultipartEncoder([("up\"loads", ('a"b\r\n.txt', b"x"))])
+        self.assertIn(b'name="up%22loads"; filename="a%22b%0D%0A.txt"', encoder.read())
+
+    def test_read_sizes(self):
+        expected = MultipartEncoder(
+            [("uploads", ("data.bin", io.BytesIO(bytes(range(256)) * 300)))],
+            boundary="b").read()
+
+        for size in (1, 2, 7, 100, 1 << 16, len(expected) + 1):
+            encoder = MultipartEncoder(
+                [("uploads", ("data.bin", io.BytesIO(bytes(range(256)) * 300)))],
+                boundary="b")
+            chunks = []
+            while True:
+                chunk = encoder.read(size)
+                if not chunk:
+                    break
+                self.assertLessEqual(len(chunk), size)
+                chunks.append(chunk)
+            self.assertEqual(b"".join(chunks), expected)
+            self.assertEqual(encoder.read(size), b"")
+
+    def test_read_zero(self):
+        encoder = MultipartEncoder([("name", (None, "job"))])
+        self.assertEqual(encoder.read(0), b"")
+        self.assertEqual(len(encoder.read()), len(encoder))
+
+    def test_iter(self):
+        encoder = MultipartEncoder(
+            [("uploads", ("data.bin", io.BytesIO(b"x" * 200000)))], boundary="b")
+        expected = MultipartEncoder(
+            [("uploads", ("data.bin", io.BytesIO(b"x" * 200000)))], boundary="b").read()
+        self.assertEqual(b"".join(encoder), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()